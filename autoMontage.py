@@ -5,8 +5,15 @@
 
 # Created in 2024 by Wil Gardner, Centre for Materials and Surface Science, La Trobe University
 
+import queue
+import re
 import shutil
 import os
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
 
 from MfKeyMouse import *
 from MfExtCont import *
@@ -47,16 +54,65 @@ MASK_PATH = None
 
 if MASK_PATH is not None:
     #Import required libraries
-    import numpy as np
     from PIL import Image
 
 #Path to log file and log function (logs all print statements)
 LOG_FILE_PATH = os.path.join(OUTPUT_DIR, 'script_log.txt')
+
+#Static path prefixes and rename pattern, built once rather than per tile
+TEMP_FILE_PREFIX = os.path.join(TEMP_OUTPUT_DIR, 'tempfile')
+OUTPUT_PREFIX = os.path.join(OUTPUT_DIR, FILENAME_BASE)
+TEMP_FILE_PATTERN = re.compile(r'tempfile_0(\d)\.(bmp|txt)')
+
+#Moves are a single os.replace rename when the temp and output folders share a
+#filesystem, falling back to shutil.move (copy and delete) across devices
+try:
+    _moveFile = os.replace if os.stat(TEMP_OUTPUT_DIR).st_dev == os.stat(OUTPUT_DIR).st_dev else shutil.move
+except OSError:
+    _moveFile = shutil.move
+
+def _batchRename(pairs):
+    """Applies a batch of (src, dst) file moves in one pass"""
+
+    for src, dst in pairs:
+        _moveFile(src, dst)
+
+#Log messages are queued and drained to disk by a background thread, so the
+#acquisition loop never blocks on the log file
+_logQueue = queue.SimpleQueue()
+def _logWorker():
+    logFile = None
+    while True:
+        message = _logQueue.get()
+        if message is None:
+            break
+        if logFile is None:
+            logFile = open(LOG_FILE_PATH, 'a', buffering=8192)
+        logFile.write(message + '\n')
+        if _logQueue.empty():
+            logFile.flush() #Keep the log readable while the montage runs
+    if logFile is not None:
+        logFile.close()
+
+_logThread = threading.Thread(target=_logWorker, daemon=True)
+_logThread.start()
+
 def log_message(message):
-    with open(LOG_FILE_PATH, 'a') as log_file:
-        log_file.write(message + '\n')
+    _logQueue.put_nowait(message)
+
+def flushLog():
+    """Stops the log thread and flushes any queued messages to disk"""
+
+    _logQueue.put_nowait(None)
+    _logThread.join()
 
 def Script():
+    # Start decoding the mask image in the background so the PIL load
+    # overlaps with the SEM setup RPCs below
+    if MASK_PATH is not None:
+        maskPool = ThreadPoolExecutor(max_workers=1)
+        maskFuture = maskPool.submit(loadGrayscale, MASK_PATH)
+
     # Get current coordinates
     r = EXT.GetStagePosition()
     startCoords = [r[2], r[3]]
@@ -77,8 +133,17 @@ def Script():
         magValue = MAG_VALUE
     log_message(f'Magnification value: {magValue}')
 
+    # All magnification changes go through one memoized setter, so no-op
+    # transitions never cost an RPC to the microscope
+    currentMag = None
+    def setMagnification(value):
+        nonlocal currentMag
+        if currentMag != value:
+            r = EXT.SetMagnification(Value=value)
+            currentMag = value
+
     # Set Magnification
-    r = EXT.SetMagnification(Value=magValue)
+    setMagnification(magValue)
 
     # Compute tile height and width from magnification
     tileHeight, tileWidth = computeTileSize(magValue=magValue)
@@ -96,92 +161,111 @@ def Script():
 
     # Load mask if path is not None
     if MASK_PATH is not None:
-        # Load image, resize to match tiles, and binarize
-        binary_image = rgbToTileBinary(MASK_PATH, (numTilesWidth, numTilesHeight))
-    
-        # Flatten to match the zig-zag capture
-        mask = zigzagFlatten(binary_image)
+        # Join the background load, then resize to match tiles and binarize
+        binary_image = rgbToTileBinary(maskFuture.result(), (numTilesWidth, numTilesHeight))
+        maskPool.shutdown()
+
+        # Flatten to match the Hilbert-order capture
+        mask = captureOrderFlatten(binary_image)
 
         if len(mask) != len(capturePositions):
             log_message('ERROR! Mask length not equal to capturePositions length.')
+            flushLog()
             Exit()
             return
-        log_message(f'Approximate time to complete montage (hr): {SEC_PER_TILE*np.count_nonzero(mask)/3600}')
-    else:
-        log_message(f'Approximate time to complete montage (hr): {SEC_PER_TILE*len(capturePositions)}')
-        
+
+        # Keep only the masked-in tiles so the capture loop has no per-tile branch
+        capturePositions = capturePositions[np.flatnonzero(mask)]
+
+    log_message(f'Approximate time to complete montage (hr): {SEC_PER_TILE*len(capturePositions)/3600}')
+
+
     # Set HV-ON
     r = EXT.SetHv(OnOff='ON')
 
-    # Capture at all positions
-    for i, [X, Y] in enumerate(capturePositions):
-        
-        if MASK_PATH is not None and not mask[i]:
-            continue
-        
+    # Background pool so file renames overlap with the next stage move
+    renamePool = ThreadPoolExecutor(max_workers=2)
+    renameFutures = deque()
+
+    # The feature flags are constant for a run, so resolve them once and
+    # build the per-tile routine from only the steps this run actually uses
+    def makeTileStep():
+        steps = []
+
         # Move stage with coords (X and Y)
-        r = EXT.RunStageMove(X=X, Y=Y)
-        log_message(f'Moved stage to position {i}: X={X}, Y={Y}')
+        def moveStage(i, X, Y):
+            r = EXT.RunStageMove(X=X, Y=Y)
+            log_message(f'Moved stage to position {i}: X={X}, Y={Y}')
+        steps.append(moveStage)
 
         # ABCC
         if USE_ABC:
-            r = EXT.RunAutoAbc(Mode=ABC_MODE, Bm=0)
-            log_message('Auto brightness and contrast correction applied.')
+            def autoBrightnessContrast(i, X, Y):
+                r = EXT.RunAutoAbc(Mode=ABC_MODE, Bm=0)
+                log_message('Auto brightness and contrast correction applied.')
+            steps.append(autoBrightnessContrast)
 
         # AFC
         if USE_AUTO_FOCUS:
-            #Set new magnficiation
-            if magValue < AFC_MAG:
-                r = EXT.SetMagnification(Value=AFC_MAG)
-            
-            #Recursively focus
-            focusSuccessful = recursiveAutofocus(tileWidth=tileWidth, focusThreshold=FOCUS_THRESHOLD, xStart=X, maxRecursions=MAX_AFC_RECURSIONS)
-            if focusSuccessful:
-                log_message('Recursive auto focus applied successfully.')
-            else:
-                log_message('Recursive auto focus failed. Using previous tile focus.')
-    
+            raiseMag = magValue < AFC_MAG
+            def autoFocus(i, X, Y):
+                #Set new magnficiation
+                if raiseMag:
+                    setMagnification(AFC_MAG)
+
+                #Recursively focus
+                focusSuccessful = recursiveAutofocus(tileWidth=tileWidth, focusThreshold=FOCUS_THRESHOLD, xStart=X, maxRecursions=MAX_AFC_RECURSIONS)
+                if focusSuccessful:
+                    log_message('Recursive auto focus applied successfully.')
+                else:
+                    log_message('Recursive auto focus failed. Using previous tile focus.')
+
+                # Restore Magnification (a no-op unless raised above)
+                setMagnification(magValue)
+            steps.append(autoFocus)
+
         # AST
         if USE_AUTO_ASTIGMA:
-            r = EXT.RunAutoAsc()
-            log_message('Auto astigmatism correction applied.')
-
-        # Set Magnification
-        r = EXT.SetMagnification(Value=magValue)
+            def autoAstigmatism(i, X, Y):
+                r = EXT.RunAutoAsc()
+                log_message('Auto astigmatism correction applied.')
+            steps.append(autoAstigmatism)
 
         # Capture
-        r = EXT.RunCapture(
-            Type=CAPTURE_TYPE, 
-            Dir=TEMP_OUTPUT_DIR, 
-            File='tempfile'
-        )
-        log_message(f'Captured image at position {i}.')
-
-        ## Rename capture files (bmp file and txt file)
-        if CAPTURE_TYPE == 0:
-            # Iterate filename
-            filename = f'{FILENAME_BASE}_{i}'
-            shutil.move(
-                os.path.join(TEMP_OUTPUT_DIR, "tempfile.bmp"), 
-                os.path.join(OUTPUT_DIR, f"{filename}.bmp")
-            )
-            shutil.move(
-                os.path.join(TEMP_OUTPUT_DIR, "tempfile.txt"), 
-                os.path.join(OUTPUT_DIR, f"{filename}.txt")
+        def capture(i, X, Y):
+            # Wait for the previous tile's renames before new tempfiles are written
+            while renameFutures:
+                renameFutures.popleft().result()
+
+            r = EXT.RunCapture(
+                Type=CAPTURE_TYPE,
+                Dir=TEMP_OUTPUT_DIR,
+                File='tempfile'
             )
-        else:
-            # Save all detector images as separate files
-            for j in range(6): #TODO only loop through ACTIVE detectors
-                f_path = os.path.join(TEMP_OUTPUT_DIR, f'tempfile_0{j}')
-                if os.path.exists(f'{f_path}.bmp'):
-                    # Iterate filename with scan number and detector number
-                    filename = f'{FILENAME_BASE}_d{j}_{i}'
-                    shutil.move(f'{f_path}.bmp', os.path.join(OUTPUT_DIR, f'{filename}.bmp'))
-                    shutil.move(f'{f_path}.txt', os.path.join(OUTPUT_DIR, f'{filename}.txt'))
-        log_message(f'Files saved for position {i}.')
-        # Run
-        state = 0                              # 0:Run, 1:Freeze, 2:Freeze(forced)
-        r = EXT.RunScan(ScanState = state)
+            log_message(f'Captured image at position {i}.')
+
+            # Rename the capture files in the background so the next stage move
+            # is not blocked on filesystem latency
+            renameFutures.append(renamePool.submit(renameCaptureFiles, i))
+            # Run
+            state = 0                              # 0:Run, 1:Freeze, 2:Freeze(forced)
+            r = EXT.RunScan(ScanState = state)
+        steps.append(capture)
+
+        def tileStep(i, X, Y):
+            for step in steps:
+                step(i, X, Y)
+        return tileStep
+
+    # Capture at all positions
+    tileStep = makeTileStep()
+    for i in range(len(capturePositions)):
+        tileStep(i, int(capturePositions[i, 0]), int(capturePositions[i, 1]))
+
+    # Wait for any outstanding renames to finish
+    while renameFutures:
+        renameFutures.popleft().result()
+    renamePool.shutdown()
 
     # Return to start position
     r = EXT.RunStageMove(X=startCoords[0], Y=startCoords[1])
@@ -192,14 +276,62 @@ def Script():
         r = EXT.SetHv(OnOff='OFF')
         log_message('HV set to OFF.')
 
+    flushLog()
     Exit()
     return
 
 #Helper functions
+_activeDetectors = None #Detector indices discovered on the first capture and reused afterwards
+def renameCaptureFiles(i):
+    """Moves the capture files (bmp and txt) for tile i from the temp folder to the output folder"""
+
+    global _activeDetectors
+
+    if CAPTURE_TYPE == 0:
+        # Iterate filename
+        _batchRename([
+            (f'{TEMP_FILE_PREFIX}.bmp', f'{OUTPUT_PREFIX}_{i}.bmp'),
+            (f'{TEMP_FILE_PREFIX}.txt', f'{OUTPUT_PREFIX}_{i}.txt'),
+        ])
+    else:
+        # Save all detector images as separate files
+        if _activeDetectors:
+            # Rename the known detector files directly, no directory scan needed
+            try:
+                _batchRename([
+                    (f'{TEMP_FILE_PREFIX}_0{detector}.{extension}', f'{OUTPUT_PREFIX}_d{detector}_{i}.{extension}')
+                    for detector in _activeDetectors
+                    for extension in ('bmp', 'txt')
+                ])
+            except FileNotFoundError:
+                # Detector set changed mid-run, so rediscover it below
+                _activeDetectors = None
+        if not _activeDetectors:
+            # Discover which detectors actually produced files on this capture,
+            # then submit their renames as one batch
+            pairs = []
+            detectors = set()
+            with os.scandir(TEMP_OUTPUT_DIR) as entries:
+                for entry in entries:
+                    match = TEMP_FILE_PATTERN.fullmatch(entry.name)
+                    if match is None:
+                        continue
+                    # Iterate filename with scan number and detector number
+                    detector, extension = match.groups()
+                    pairs.append((entry.path, f'{OUTPUT_PREFIX}_d{detector}_{i}.{extension}'))
+                    detectors.add(detector)
+            _batchRename(pairs)
+            _activeDetectors = sorted(detectors)
+    log_message(f'Files saved for position {i}.')
+
+_photoSizeCache = None #Session cache for the GetPhotoSize RPC
 def computeTileSize(magValue):
     """Computes the tile height and width (in nm) based on magnification"""
 
-    photoSize = EXT.GetPhotoSize();  # Command to SU7000 to grab the current frame size (seems to be an arbitrary number)
+    global _photoSizeCache
+    if _photoSizeCache is None:
+        _photoSizeCache = EXT.GetPhotoSize()  # Command to SU7000 to grab the current frame size (seems to be an arbitrary number)
+    photoSize = _photoSizeCache
     #Calculate actual image height/width (in millimetres)
     tileWidth = (0.127 * photoSize[3] / magValue); 
     tileHeight = (0.09525 * photoSize[3] / magValue)
@@ -211,105 +343,154 @@ def computeCapturePositions(startCoords, totalHeight, totalWidth, tileHeight, ti
 
     xStart, yStart = startCoords
 
-    # Calculate effective tile dimensions considering overlap
-    effectiveTileHeight = int(tileHeight * (1 - tileOverlap))
-    effectiveTileWidth = int(tileWidth * (1 - tileOverlap))
- 
+    # Convert to nm up front so everything below is integer arithmetic, rather
+    # than truncating the effective tile dimensions to whole millimetres
+    totalHeight = int(totalHeight * 1E6)
+    totalWidth = int(totalWidth * 1E6)
+
+    # Calculate effective tile dimensions (in nm) considering overlap
+    effectiveTileHeight = int(tileHeight * 1E6 * (1 - tileOverlap))
+    effectiveTileWidth = int(tileWidth * 1E6 * (1 - tileOverlap))
+
     # Adjust totalHeight and totalWidth to be multiples of effectiveTileHeight and effectiveTileWidth
     totalHeight -= totalHeight % effectiveTileHeight
-    totalWidth -= totalWidth % effectiveTileWidth  
-    
-    # Convert to nm
-    totalHeight *= 1E6
-    totalWidth *= 1E6
-    effectiveTileHeight *= 1E6
-    effectiveTileWidth *= 1E6 
+    totalWidth -= totalWidth % effectiveTileWidth
 
     # Calculate the number of tiles in each dimension
-    numTilesHeight = int(totalHeight / effectiveTileHeight)
-    numTilesWidth = int(totalWidth / effectiveTileWidth)
-
-    capturePositions = []
-
-    # Generate positions in a zig-zag pattern
-    for row in range(numTilesHeight):
-        if row % 2 == 0:  # Moving right
-            for col in range(numTilesWidth):
-                x = xStart + col * effectiveTileWidth
-                y = yStart + row * effectiveTileHeight
-                capturePositions.append([int(x), int(y)])
-        else:  # Moving left
-            for col in range(numTilesWidth - 1, -1, -1):
-                x = xStart + col * effectiveTileWidth
-                y = yStart + row * effectiveTileHeight
-                capturePositions.append([int(x), int(y)])
-    
-    return capturePositions, numTilesHeight, numTilesWidth
-
-def recursiveAutofocus(tileWidth, focusThreshold, xStart, offset=0, maxRecursions=5):
-    """A recursive function to apply autofocus at an offset location if unsuccesful at current location"""
-
-    if maxRecursions <= 0:
-        #Focus unsuccessful so return False
-        return False
+    numTilesHeight = totalHeight // effectiveTileHeight
+    numTilesWidth = totalWidth // effectiveTileWidth
+
+    # Fill a single preallocated contiguous (N, 2) int64 array with the
+    # row-major grid of positions, broadcasting straight into its columns
+    positions = np.empty((numTilesHeight * numTilesWidth, 2), dtype=np.int64)
+    grid = positions.reshape(numTilesHeight, numTilesWidth, 2)
+    cols = np.arange(numTilesWidth, dtype=np.int64)
+    rows = np.arange(numTilesHeight, dtype=np.int64)
+    grid[:, :, 0] = xStart + cols * effectiveTileWidth
+    grid[:, :, 1] = (yStart + rows * effectiveTileHeight)[:, np.newaxis]
+
+    # Gather the grid into Hilbert order so successive tiles stay
+    # spatially close, minimising stage travel between captures
+    positions = positions[captureOrderPermutation(numTilesHeight, numTilesWidth)]
+
+    # Log stage travel for the Hilbert order against the old zig-zag raster
+    diffs = np.diff(positions, axis=0)
+    travelDistance = np.hypot(diffs[:, 0], diffs[:, 1]).sum()
+    rasterDistance = numTilesHeight * (numTilesWidth - 1) * effectiveTileWidth \
+        + (numTilesHeight - 1) * effectiveTileHeight
+    log_message(f'Total stage travel (nm): {travelDistance:.0f} (zig-zag raster: {rasterDistance:.0f})')
+
+    return positions, numTilesHeight, numTilesWidth
+
+def hilbertCurveIndices(numRows, numCols):
+    """Computes (row, col) indices covering a numRows x numCols grid in Hilbert curve order"""
+
+    # Pad the grid to the next power of two and filter out-of-range coordinates
+    side = 1
+    while side < max(numRows, numCols):
+        side *= 2
+
+    indices = []
+    for d in range(side * side):
+        # Map distance d along the curve to (col, row) via iterative bit rotation
+        col, row, t, s = 0, 0, d, 1
+        while s < side:
+            rx = 1 & (t // 2)
+            ry = 1 & (t ^ rx)
+            # Rotate the quadrant
+            if ry == 0:
+                if rx == 1:
+                    col = s - 1 - col
+                    row = s - 1 - row
+                col, row = row, col
+            col += s * rx
+            row += s * ry
+            t //= 4
+            s *= 2
+        if row < numRows and col < numCols:
+            indices.append((row, col))
+
+    return indices
+
+def captureOrderPermutation(numRows, numCols):
+    """Computes the flat index permutation from row-major order to the Hilbert capture order"""
+
+    return np.array([row * numCols + col
+                     for row, col in hilbertCurveIndices(numRows, numCols)], dtype=np.int64)
+
+_lastWorkingDistance = None #Working distance measured by the previous autofocus
+_lastFocusX = None #Stage X position (nm) where it was measured
+def recursiveAutofocus(tileWidth, focusThreshold, xStart, maxRecursions=5):
+    """Applies autofocus, retrying at offset locations if unsuccesful at the current location"""
+
+    global _lastWorkingDistance, _lastFocusX
+
+    focusSuccessful = False
+    offset = 0
+    for _ in range(maxRecursions):
+
+        if offset > 0:
+            r = EXT.RunStageMove(X=xStart + offset)
+
+        #Get current focus
+        r = EXT.GetFocus()
+        oldFocus = r[2]
+
+        #Reuse the previous autofocus working distance when the stage has only
+        #moved a neighbouring-tile distance, since focus is likely unchanged
+        if _lastWorkingDistance is not None and abs(xStart + offset - _lastFocusX) < tileWidth * 1E6:
+            oldWorkingDistance = _lastWorkingDistance
+        else:
+            r = EXT.GetWorkingDistance()
+            oldWorkingDistance = r[2]
 
-    xNew = xStart + offset
+        #Run autofocus
+        r = EXT.RunAutoAfc()
 
-    if offset > 0:
-        
-        r = EXT.RunStageMove(X=xNew)
-
-    #Get current focus and working distance
-    r = EXT.GetFocus()
-    oldFocus = r[2]
-    r = EXT.GetWorkingDistance()
-    oldWorkingDistance = r[2]
-    
-    #Run autofocus
-    r = EXT.RunAutoAfc()
+        #Get new working distance
+        r = EXT.GetWorkingDistance()
+        newWorkingDistance = r[2]
 
-    #Get new working distance
-    r = EXT.GetWorkingDistance()
-    newWorkingDistance = r[2]
+        if abs(newWorkingDistance - oldWorkingDistance) <= focusThreshold:
+            #Cache the accepted working distance for neighbouring tiles
+            _lastWorkingDistance = newWorkingDistance
+            _lastFocusX = xStart + offset
+            focusSuccessful = True
+            break
 
-    focusSuccessful = True
-    if abs(newWorkingDistance - oldWorkingDistance) > focusThreshold:
-                
-        #Restore old focus
+        #Restore old focus and retry at an offset location, dropping the cache
+        #since the rejected reading no longer reflects the restored lens state
         r = EXT.SetFocus(Coarse=oldFocus)
+        _lastWorkingDistance = None
+        _lastFocusX = None
+        offset += int(0.1 * tileWidth)
 
-        focusSuccessful = recursiveAutofocus(tileWidth, focusThreshold, xNew, offset=int(0.1*tileWidth), maxRecursions=maxRecursions-1)
-
-        #Restore position
+    #Restore the original position with a single move
+    if offset > 0:
         r = EXT.RunStageMove(X=xStart)
+
     return focusSuccessful
     
-def rgbToTileBinary(image_path, resize_shape=None):
-    # Load image using PIL
-    image_pil = Image.open(image_path)
-    
+def loadGrayscale(image_path):
+    """Loads an image with PIL and converts it to grayscale"""
+
+    return Image.open(image_path).convert('L')
+
+def rgbToTileBinary(grayscale_image, resize_shape=None):
     # Resize image if requested
     if resize_shape is not None:
-        image_pil = image_pil.resize(resize_shape, Image.BICUBIC)
-    
-    # Convert image to grayscale
-    grayscale_image = image_pil.convert('L')
-    
-    # Convert grayscale image to numpy array
-    grayscale_array = np.array(grayscale_image) / 255.0  # Normalize to range [0, 1]
+        grayscale_image = grayscale_image.resize(resize_shape, Image.BICUBIC)
 
-    # Apply thresholding
-    binary_image = grayscale_array >= 0.5
-    binary_image = binary_image.astype('int')
+    # Apply thresholding directly in uint8 (128/255 is the same cut as 0.5 after normalising)
+    binary_image = (np.asarray(grayscale_image) >= 128).view(np.uint8)
 
     return binary_image
 
-def zigzagFlatten(array_2d):
+def captureOrderFlatten(array_2d):
     # Flip the entire array vertically
     array_2d = np.flip(array_2d, axis=0)
 
-    # Flip every second row starting from the second from bottom
-    array_2d[1::2] = np.flip(array_2d[1::2], axis=1)
-    
-    # Flatten the array
-    return np.reshape(array_2d, (1, -1))
\ No newline at end of file
+    # Gather in one shot with the same permutation used by computeCapturePositions,
+    # so the mask order matches the capture order by construction
+    numRows, numCols = array_2d.shape
+    return array_2d.ravel()[captureOrderPermutation(numRows, numCols)]
\ No newline at end of file